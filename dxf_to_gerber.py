@@ -44,6 +44,11 @@ import math;
 import re;
 import os;
 import glob;
+import time;
+import zlib;
+import zipfile;
+import cStringIO;
+from multiprocessing.pool import ThreadPool;
 
 class DXFFile:
     
@@ -456,9 +461,7 @@ class GerberWriter:
         self.ensure_region(f,False);
         self.emit_command(f,"M02");
         
-    def write_gerber_file(self,fname,dxf,layernames):
-        print 'Writing Gerber file %s' % fname;
-        
+    def gerber_entities(self,fname,dxf,layernames):
         entities = self.process_dxf_for_writing(dxf,layernames);
         
         print 'File will contain %d regions, %d tracks and %d circles' % (len(entities['Regions']),len(entities['Tracks']),len(entities['Circles']));
@@ -467,38 +470,63 @@ class GerberWriter:
             if len(entities['Tracks'])==0:
                 if len(entities['Circles'])==0:
                     print "File will be empty: Skipping file %s" % fname;
-                    try:
-                        os.unlink(fname);
-                    except:
-                        pass;
-                    return
+                    return None;
+                    
+        return entities;
+        
+    def write_gerber_data(self,f,entities):
+        self.write_gerber_header(f);
+        self.write_gerber_apertures(f);
+        
+        print "Writing %d Tracks" % (len(entities['Tracks']));
+        
+        for c in self.circular_apertures:
+            for p in entities['Tracks']:
+                if DXFFile.LINEWIDTH in p:
+                    if p[DXFFile.LINEWIDTH]==c:
+                        self.write_gerber_track(f,p);
+                else:
+                    if c==0.0:
+                        self.write_gerber_track(f,p);
+
+        print "Flashing %d Apertures" % (len(self.circular_apertures));           
+        for d in self.circular_apertures:
+            for c in self.no_duplicates(sorted(list(entities['Circles']),cmp=self.XthenY)):
+                if d==c[DXFFile.DIAMETER]:
+                    self.write_gerber_flash(f,c);
+
+        print "Writing %d Regions" % (len(entities['Regions']));     
+        for r in entities['Regions']:
+            self.write_gerber_region(f,r);
+    
+        self.write_gerber_trailer(f);
+        
+    def write_gerber_file(self,fname,dxf,layernames):
+        print 'Writing Gerber file %s' % fname;
+        
+        entities = self.gerber_entities(fname,dxf,layernames);
+        
+        if entities is None:
+            try:
+                os.unlink(fname);
+            except:
+                pass;
+            return
         
         with open(fname,'w') as f:
-            self.write_gerber_header(f);
-            self.write_gerber_apertures(f);
-            
-            print "Writing %d Tracks" % (len(entities['Tracks']));
+            self.write_gerber_data(f,entities);
             
-            for c in self.circular_apertures:
-                for p in entities['Tracks']:
-                    if DXFFile.LINEWIDTH in p:
-                        if p[DXFFile.LINEWIDTH]==c:
-                            self.write_gerber_track(f,p);
-                    else:
-                        if c==0.0:
-                            self.write_gerber_track(f,p);
- 
-            print "Flashing %d Apertures" % (len(self.circular_apertures));           
-            for d in self.circular_apertures:
-                for c in self.no_duplicates(sorted(list(entities['Circles']),cmp=self.XthenY)):
-                    if d==c[DXFFile.DIAMETER]:
-                        self.write_gerber_flash(f,c);
- 
-            print "Writing %d Regions" % (len(entities['Regions']));     
-            for r in entities['Regions']:
-                self.write_gerber_region(f,r);
+    def encode_gerber_layer(self,name,dxf,layernames):
+        print 'Encoding Gerber layer %s' % name;
+        
+        entities = self.gerber_entities(name,dxf,layernames);
         
-            self.write_gerber_trailer(f);
+        if entities is None:
+            return None;
+        
+        f = cStringIO.StringIO();
+        self.write_gerber_data(f,entities);
+        return f.getvalue();
         
     # To do with excellon
     
@@ -541,65 +569,135 @@ class GerberWriter:
     def write_excellon_trailer(self,f):
         print >> f, "M30";
     
+    def write_excellon_data(self,f,entities):
+        diameters = sorted(list(self.circular_apertures));
+    
+        self.write_excellon_header(f);
+        self.write_excellon_drills(f);
+        
+        print >> f, "%";
+        print >> f, "G05";
+                        
+        for dia in diameters:
+            print "Diameter = %g" % (dia);
+            
+            if dia==0.0:
+                print "Skipping diameter 0 holes";
+                continue;
+            
+            print "Processing entries for drill diameter %g" % (dia);
+                            
+            holes = list(self.no_duplicates(sorted(entities['Circles'],cmp=self.XthenY)));
+            
+            print "Drilling %d holes\n" % len(holes);
+                            
+            for circle in holes: 
+                if circle[DXFFile.DIAMETER]==dia:
+                    self.write_excellon_drill_point(f,circle);
+                                            
+          #  print "Making %d cuts\n" % len(entities['Tracks']);
+          #  
+          #  print >> f, "G01";
+          #  
+          #  for p in entities['Tracks']:
+          #      if DXFFile.LINEWIDTH in p:
+          #          if p[DXFFile.LINEWIDTH]==dia:
+          #              self.write_excellon_cut(f,p);
+          #      else:
+          #          raise Exception("Error: trying to cut a slot with zero cutter width");
+          #    
+          #  print "Making %d cut-outs\n" % (len(entities['Regions']));
+          #  
+          #  print >> f, "G01";
+          #
+          #  for r in entities['Regions']:        
+          #      print r;        
+          #      if DXFFile.LINEWIDTH in r:
+          #          print "Cut-out has width %g" % (r[DXFFile.LINEWIDTH]);
+          #          if r[DXFFile.LINEWIDTH]==dia:
+          #              self.write_excellon_cutout(f,r);
+          #      else:
+          #          raise Exception("Error: trying to cut a cut-out with zero cutter width");
+          
+        self.write_excellon_trailer(f);
+        
     def write_excellon_file(self,fname,dxf,layernames):
         print 'Writing Excellon file %s' % fname;
 
-        killfile = True;
         entities = self.process_dxf_for_writing(dxf,layernames);
-        diameters = sorted(list(self.circular_apertures));
     
         with open(fname,'w') as f:
-
-            self.write_excellon_header(f);
-            self.write_excellon_drills(f);
+            self.write_excellon_data(f,entities);
             
-            print >> f, "%";
-            print >> f, "G05";
-                            
-            for dia in diameters:
-                print "Diameter = %g" % (dia);
-                
-                if dia==0.0:
-                    print "Skipping diameter 0 holes";
-                    continue;
+    def encode_excellon_layer(self,name,dxf,layernames):
+        print 'Encoding Excellon layer %s' % name;
+
+        entities = self.process_dxf_for_writing(dxf,layernames);
+        
+        f = cStringIO.StringIO();
+        self.write_excellon_data(f,entities);
+        return f.getvalue();
+        
+    # To do with the zipped fab package
+    
+    @staticmethod
+    def deflate_layer(data):
+        # Raw deflate stream (no zlib header), as stored in a zip member
+        co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,zlib.DEFLATED,-15);
+        return (len(data),zlib.crc32(data) & 0xffffffff,co.compress(data)+co.flush());
+        
+    @staticmethod
+    def write_zip_member(z,name,deflated):
+        # Append an already deflated member, as ZipFile.writestr would
+        size,crc,body = deflated;
+        zinfo = zipfile.ZipInfo(name,time.localtime(time.time())[:6]);
+        zinfo.compress_type = zipfile.ZIP_DEFLATED;
+        zinfo.external_attr = 0600 << 16;
+        zinfo.file_size = size;
+        zinfo.compress_size = len(body);
+        zinfo.CRC = crc;
+        zinfo.header_offset = z.fp.tell();
+        z._writecheck(zinfo);
+        z._didModify = True;
+        z.fp.write(zinfo.FileHeader());
+        z.fp.write(body);
+        z.filelist.append(zinfo);
+        z.NameToInfo[zinfo.filename] = zinfo;
+        
+    def write_cam_zip(self,zname,dxf):
+        print 'Writing fab package %s' % zname;
+        
+        member_base = os.path.basename(self.cam_base);
+        pending = list();
+        pool = ThreadPool();
+        
+        # Layers are encoded in turn, as the writer state is shared, but each one
+        # is handed to a worker thread to be deflated while the next is encoded
+        
+        try:
+            for extension in self.gerber_layers:
+                name = member_base+extension;
+                print "Encoding data of type %s to member %s" % (self.gerber_layers[extension][0],name);
+                data = self.encode_gerber_layer(name,dxf,self.gerber_layers[extension]);
+                if data is not None:
+                    pending.append((name,pool.apply_async(self.deflate_layer,(data,))));
+                print "";
                 
-                print "Processing entries for drill diameter %g" % (dia);
-                                
-                holes = list(self.no_duplicates(sorted(entities['Circles'],cmp=self.XthenY)));
+            for extension in self.excellon_layers:
+                name = member_base+extension;
+                print "Encoding data of type %s to member %s" % (self.excellon_layers[extension][0],name);
+                data = self.encode_excellon_layer(name,dxf,self.excellon_layers[extension]);
+                pending.append((name,pool.apply_async(self.deflate_layer,(data,))));
+                print "";
                 
-                print "Drilling %d holes\n" % len(holes);
-                                
-                for circle in holes: 
-                    if circle[DXFFile.DIAMETER]==dia:
-                        self.write_excellon_drill_point(f,circle);
-                                                
-              #  print "Making %d cuts\n" % len(entities['Tracks']);
-              #  
-              #  print >> f, "G01";
-              #  
-              #  for p in entities['Tracks']:
-              #      if DXFFile.LINEWIDTH in p:
-              #          if p[DXFFile.LINEWIDTH]==dia:
-              #              self.write_excellon_cut(f,p);
-              #      else:
-              #          raise Exception("Error: trying to cut a slot with zero cutter width");
-              #    
-              #  print "Making %d cut-outs\n" % (len(entities['Regions']));
-              #  
-              #  print >> f, "G01";
-              #
-              #  for r in entities['Regions']:        
-              #      print r;        
-              #      if DXFFile.LINEWIDTH in r:
-              #          print "Cut-out has width %g" % (r[DXFFile.LINEWIDTH]);
-              #          if r[DXFFile.LINEWIDTH]==dia:
-              #              self.write_excellon_cutout(f,r);
-              #      else:
-              #          raise Exception("Error: trying to cut a cut-out with zero cutter width");
-              
-            self.write_excellon_trailer(f);
-                                                                    
-    def process_cam(self,dxf,camname=None):
+            with zipfile.ZipFile(zname,'w',zipfile.ZIP_DEFLATED) as z:
+                for name,result in pending:
+                    self.write_zip_member(z,name,result.get());
+        finally:
+            pool.close();
+            pool.join();
+            
+    def process_cam(self,dxf,camname=None,zipname=None):
         
         self.clear_aperture_cache();
         self.measure_dxf_file(dxf);
@@ -610,6 +708,13 @@ class GerberWriter:
             camname = dxf.filename;
             
         self.cam_base = os.path.splitext(camname)[0];
+        
+        # Optionally write every layer straight into one zip archive for the fab
+        
+        if zipname != None:
+            self.write_cam_zip(zipname,dxf);
+            print "\n\nDone\n";
+            return;
                 
         # For each layer, produce a Gerber or Excellon file
         